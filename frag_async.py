@@ -0,0 +1,356 @@
+"""
+asyncio variants of fragment_file and defragment_files
+
+reading, encoding / decoding and writing run as separate stages connected by bounded queues,
+so while one fragment is being encoded the next one is being read and the previous one written
+blocking file io runs in the default executor, cpu work runs in cpu_executor (e.g. a ProcessPoolExecutor)
+"""
+import asyncio
+import functools
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any
+from typing import AsyncGenerator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from frag_file import FragmentedFile
+from frag_file import HASH_FUNCTION
+from frag_file import _encode_fragment
+from frag_file import _find_fragmented_files
+from frag_file import _report_restoration
+from frag_file import _restoration
+from frag_file import _plan_fragments
+from frag_file import _unique_salt_and_iv
+from frag_file import _write_fragment
+from frag_utils import DurableWriter
+from frag_utils import format_bytes
+from frag_utils import new_hash
+from frag_utils import read_receipts
+from frag_utils import write_receipts
+
+
+async def _in_executor(executor: Optional[Executor], func: Callable, *args: Any) -> Any:
+    """
+    run func in executor, but if cancelled, wait for the call to finish before re-raising
+    the executor can't interrupt a running call, so otherwise cleanup could race with it
+    """
+    future = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                pass
+        raise
+
+
+async def _run_stages(*stages: Awaitable) -> None:
+    """
+    run pipeline stages concurrently, cancelling the others if any of them fails
+    since every stage runs its blocking calls via _in_executor, no executor calls are in flight on return
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def fragment_file_async(file_path: Path,
+                              output_dir: Path,
+                              password: Optional[str] = None,
+                              max_size: int = 22000000,
+                              size_range: int = 4000000,
+                              verbose: bool = False,
+                              relative_path: Optional[str] = None,
+                              durability: str = 'none',
+                              hash_func: str = HASH_FUNCTION,
+                              max_encoded_size: Optional[int] = None,
+                              fragment_count: Optional[int] = None,
+                              batch_quota: Optional[int] = None,
+                              shard_depth: int = 0,
+                              queue_size: int = 2,
+                              cpu_executor: Optional[Executor] = None,
+                              duplicate_paths: Optional[List[str]] = None,
+                              file_hash: Optional[str] = None,
+                              ) -> List[Path]:
+    """
+    same as fragment_file, but overlaps reading, encoding and writing of consecutive fragments
+    queue_size limits how many fragments can be waiting between stages (and hence memory usage)
+    """
+    loop = asyncio.get_running_loop()
+    file_header, fragment_sizes = await loop.run_in_executor(None, _plan_fragments, file_path, max_size, size_range,
+                                                             relative_path, hash_func, max_encoded_size,
+                                                             fragment_count, batch_quota, duplicate_paths,
+                                                             file_hash)
+    if verbose:
+        print(f'fragmentation target path is <{file_path}>')
+        print(f'fragmentation target hash is {file_header["file_hash"]}')
+        print(f'fragmentation target size is {format_bytes(file_header["file_size"])}')
+        print(f'creating {len(fragment_sizes)} fragments...')
+
+    # create output folder
+    output_dir = output_dir.resolve()
+    await loop.run_in_executor(None, functools.partial(output_dir.mkdir, parents=True, exist_ok=True))
+    assert output_dir.is_dir()
+
+    read_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    fragment_paths = []
+    writer = DurableWriter(durability)
+
+    async def read_stage():
+        f_in = await _in_executor(None, file_path.open, 'rb')
+        try:
+            for fragment_size in fragment_sizes:
+                fragment_start = f_in.tell()
+                fragment_raw = await _in_executor(None, f_in.read, fragment_size)
+                assert len(fragment_raw) == fragment_size, f'could not read file, may have been modified'
+                await read_queue.put((fragment_start, fragment_raw))
+
+            # make sure the entire file has been processed
+            assert len(await _in_executor(None, f_in.read)) == 0, f'file may have been modified!'
+        finally:
+            f_in.close()
+        await read_queue.put(None)
+
+    async def encode_stage():
+        seen_password_salts = {None}
+        seen_initialization_vectors = {None, bytes(16)}
+        while True:
+            item = await read_queue.get()
+            if item is None:
+                break
+            fragment_start, fragment_raw = item
+            password_salt, initialization_vector = _unique_salt_and_iv(seen_password_salts,
+                                                                       seen_initialization_vectors)
+            encoded = await _in_executor(cpu_executor, _encode_fragment, fragment_raw,
+                                         dict(file_header, fragment_start=fragment_start),
+                                         password, password_salt, initialization_vector)
+            await write_queue.put((fragment_start, len(fragment_raw), encoded))
+        await write_queue.put(None)
+
+    async def write_stage():
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                break
+            fragment_start, fragment_size, (fragment_hash, fragment_name, header_lines, fragment_encoded) = item
+            if verbose:
+                print(f'fragment [{len(fragment_paths) + 1}/{len(fragment_sizes)}] {fragment_hash}'
+                      f' -> {format_bytes(fragment_size)} from byte {fragment_start}')
+            fragment_paths.append(await _in_executor(None, _write_fragment, output_dir, writer,
+                                                     fragment_name, header_lines, fragment_encoded, shard_depth))
+        await _in_executor(None, writer.flush)
+
+    try:
+        await _run_stages(read_stage(), encode_stage(), write_stage())
+    except BaseException:
+        await _in_executor(None, writer.discard)
+        raise
+
+    # return ordered list of fragment file paths
+    return fragment_paths
+
+
+async def make_file_async(fragmented_file: FragmentedFile,
+                          output_dir: Path,
+                          file_name: Optional[str] = None,
+                          remove_originals: bool = True,
+                          overwrite: bool = False,
+                          verbose: bool = False,
+                          durability: str = 'none',
+                          strict_verify: bool = False,
+                          queue_size: int = 2,
+                          cpu_executor: Optional[Executor] = None,
+                          receipts: Optional[Dict[str, dict]] = None,
+                          ) -> Optional[Path]:
+    """
+    same as FragmentedFile.make_file, but overlaps reading, decoding and writing of consecutive fragments
+    """
+    loop = asyncio.get_running_loop()
+
+    # which fragment_set to make from
+    extraction_plan = fragmented_file.get_extraction_plan()
+    assert extraction_plan is not None
+
+    if verbose:
+        print(f'restoring {format_bytes(fragmented_file.file_size)} from {len(extraction_plan)} fragments'
+              f' of {fragmented_file.file_name}')
+
+    # where output file will be written, and whether it still needs to be written
+    file_path, needs_writing = await loop.run_in_executor(None, fragmented_file._prepare_output, output_dir,
+                                                          file_name, overwrite, verbose, strict_verify, receipts)
+    if not needs_writing:
+        if file_path is not None and remove_originals:
+            await loop.run_in_executor(None, fragmented_file.remove)
+        return file_path
+
+    read_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    writer = DurableWriter(durability)
+
+    async def read_stage():
+        for required_length, text_fragment in extraction_plan:
+            encoded = await _in_executor(None, text_fragment.read_encoded)
+            await read_queue.put((required_length, text_fragment, encoded))
+        await read_queue.put(None)
+
+    async def decode_stage():
+        while True:
+            item = await read_queue.get()
+            if item is None:
+                break
+            required_length, text_fragment, encoded = item
+            content = await _in_executor(cpu_executor, text_fragment.decode, encoded, required_length)
+            await write_queue.put((text_fragment, content))
+        await write_queue.put(None)
+
+    async def write_stage():
+        partial_file = writer.open(file_path, '.partial')
+        f = await _in_executor(None, partial_file.__enter__)
+        try:
+            # write all fragments in order and update full content hash
+            hash_obj = new_hash(fragmented_file.hash_function)
+            fragment_idx = 0
+            while True:
+                item = await write_queue.get()
+                if item is None:
+                    break
+                text_fragment, content = item
+                fragment_idx += 1
+                if verbose:
+                    print(f'reading fragment [{fragment_idx}/{len(extraction_plan)}]'
+                          f' {text_fragment.fragment_hash}'
+                          f' -> {format_bytes(text_fragment.fragment_size)}'
+                          f' from byte {text_fragment.fragment_start}')
+
+                assert f.tell() == text_fragment.fragment_start
+                await _in_executor(None, hash_obj.update, content)  # hashlib releases the GIL
+                await _in_executor(None, f.write, content)
+
+            # make sure full and correct file contents have been written to disk
+            assert f.tell() == fragmented_file.file_size
+            assert fragmented_file.file_hash == hash_obj.hexdigest().upper()
+
+        # delete the partial file if anything failed (including cancellation)
+        # the write that was in flight has finished by now, so it can't recreate the file afterwards
+        except BaseException as e:
+            await _in_executor(None, partial_file.__exit__, type(e), e, e.__traceback__)
+            raise
+
+        await _in_executor(None, partial_file.__exit__, None, None, None)
+        await _in_executor(None, writer.flush)
+
+        # so that the next run doesn't need to rehash this file
+        await _in_executor(None, write_receipts, output_dir.resolve(), fragmented_file.hash_function,
+                           {file_path: fragmented_file.file_hash}, receipts)
+
+    try:
+        await _run_stages(read_stage(), decode_stage(), write_stage())
+    except BaseException:
+        await _in_executor(None, writer.discard)
+        raise
+
+    # erase originals (unless otherwise specified) and return
+    if remove_originals:
+        await loop.run_in_executor(None, fragmented_file.remove)
+    return file_path
+
+
+async def make_files_async(fragmented_file: FragmentedFile,
+                           output_dir: Path,
+                           file_name: Optional[str] = None,
+                           remove_originals: bool = True,
+                           overwrite: bool = False,
+                           verbose: bool = False,
+                           durability: str = 'none',
+                           strict_verify: bool = False,
+                           queue_size: int = 2,
+                           cpu_executor: Optional[Executor] = None,
+                           receipts: Optional[Dict[str, dict]] = None,
+                           ) -> List[Path]:
+    """
+    same as FragmentedFile.make_files, but the file itself is restored using make_file_async
+    """
+    loop = asyncio.get_running_loop()
+    copy_files = file_name is None and bool(fragmented_file.duplicate_paths)
+    file_path = await make_file_async(fragmented_file,
+                                      output_dir=output_dir,
+                                      file_name=file_name,
+                                      remove_originals=remove_originals and not copy_files,
+                                      overwrite=overwrite,
+                                      verbose=verbose,
+                                      durability=durability,
+                                      strict_verify=strict_verify,
+                                      queue_size=queue_size,
+                                      cpu_executor=cpu_executor,
+                                      receipts=receipts)
+    if file_path is None or not copy_files:
+        return [file_path] if file_path is not None else []
+
+    file_paths = [file_path] + await loop.run_in_executor(None, fragmented_file._make_duplicates, file_path,
+                                                          output_dir, overwrite, verbose, durability, strict_verify,
+                                                          receipts)
+
+    # erase originals (unless otherwise specified) and return
+    if remove_originals and len(file_paths) == 1 + len(fragmented_file.duplicate_paths):
+        await loop.run_in_executor(None, fragmented_file.remove)
+    return file_paths
+
+
+async def defragment_files_async(input_dir: Path,
+                                 password: Optional[str] = None,
+                                 file_name: Optional[str] = None,
+                                 remove_originals: bool = True,
+                                 overwrite: bool = False,
+                                 verbose: bool = False,
+                                 output_dir: Optional[Path] = None,
+                                 durability: str = 'none',
+                                 strict_verify: bool = False,
+                                 queue_size: int = 2,
+                                 cpu_executor: Optional[Executor] = None,
+                                 ) -> AsyncGenerator[Path, None]:
+    """
+    same as defragment_files, but each file is restored using make_files_async
+    """
+    loop = asyncio.get_running_loop()
+
+    input_dir = input_dir.resolve()
+    if output_dir is None:
+        output_dir = input_dir
+    fragmented_files = await loop.run_in_executor(None, _find_fragmented_files, input_dir, password)
+
+    # read the receipts file once per run rather than once per file
+    receipts = await loop.run_in_executor(None, functools.partial(read_receipts, output_dir.resolve(), compact=True))
+
+    for file_fragments in fragmented_files.values():
+        restore_kwargs = dict(output_dir=output_dir,
+                              remove_originals=remove_originals,
+                              overwrite=overwrite,
+                              verbose=verbose,
+                              durability=durability,
+                              strict_verify=strict_verify,
+                              receipts=receipts)
+        out_paths = None
+        restoration = _restoration(file_fragments)
+        if restoration == 'make_packed_files':
+            # packs are a single small fragment, so there's nothing to overlap
+            out_paths = await loop.run_in_executor(None, functools.partial(file_fragments.make_packed_files,
+                                                                           **restore_kwargs))
+        elif restoration == 'make_files':
+            out_paths = await make_files_async(file_fragments, file_name=file_name, queue_size=queue_size,
+                                               cpu_executor=cpu_executor, **restore_kwargs)
+
+        _report_restoration(file_fragments, file_name, out_paths, verbose)
+        for out_path in out_paths or []:
+            yield out_path
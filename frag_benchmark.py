@@ -0,0 +1,54 @@
+"""
+benchmark hashing throughput for each hash function and each file read method
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from frag_utils import HASH_FUNCTIONS
+from frag_utils import HASH_METHODS
+from frag_utils import format_bytes
+from frag_utils import hash_file
+from frag_utils import new_hash
+
+benchmark_size = 256 * 1024 * 1024  # 256 MiB
+
+
+def hash_file_os_read(file_path: Path, hash_func: str) -> str:
+    """
+    the original implementation, which allocates a new 64 KiB bytes object per block
+    """
+    hash_obj = new_hash(hash_func)
+    fd = os.open(str(file_path), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    for block in iter(lambda: os.read(fd, 65536), b''):
+        hash_obj.update(block)
+    os.close(fd)
+    return hash_obj.hexdigest().upper()
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = Path(temp_dir) / 'benchmark.bin'
+        print(f'writing {format_bytes(benchmark_size)} of random data to <{file_path}>')
+        with file_path.open('wb') as f:
+            for _ in range(benchmark_size // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+
+        methods = {'os.read': lambda hash_func: hash_file_os_read(file_path, hash_func)}
+        for method in HASH_METHODS:
+            methods[method] = lambda hash_func, method=method: hash_file(file_path, hash_func, method=method)
+
+        # warm the page cache so we measure hashing and not the disk
+        hash_file(file_path, 'md5')
+
+        print(f'{"hash function":<15}' + ''.join(f'{method:>15}' for method in methods))
+        for hash_func in HASH_FUNCTIONS:
+            results = []
+            for method, func in methods.items():
+                t = time.perf_counter()
+                func(hash_func)
+                results.append(benchmark_size / (time.perf_counter() - t))
+            print(f'{hash_func:<15}' + ''.join(f'{format_bytes(result) + "/s":>15}' for result in results))
+
+    print('done!')
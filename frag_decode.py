@@ -9,6 +9,7 @@ this_folder = Path(__file__).parent
 source_folder: Path = this_folder / 'ascii85_encoded'
 output_folder: Path = this_folder / 'output_decoded'
 password = 'correct 🐎 🔋 staple'  # https://xkcd.com/936/
+durability = 'batch'  # one of 'none', 'batch', 'strict'
 
 if __name__ == '__main__':
     # create folder to place plaintext fragment files
@@ -30,7 +31,13 @@ if __name__ == '__main__':
         t = time.time()
 
         # decode each bunch of fragments separately
-        for temp_archive_path in defragment_files(source_folder, password=password, verbose=True):
+        for temp_archive_path in defragment_files(source_folder, password=password, verbose=True,
+                                                  output_dir=output_folder, durability=durability):
+
+            # files fragmented without an archive are restored in place
+            if temp_archive_path.parent != output_folder.resolve() or temp_archive_path.suffix != '.tgz':
+                print(f'restored to <{temp_archive_path}>')
+                continue
 
             # unzip
             print(f'restored to <{temp_archive_path}>, unpacking archive to <{output_folder}>...')
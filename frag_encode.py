@@ -3,6 +3,7 @@ import tarfile
 import time
 from pathlib import Path
 
+from frag_file import fragment_directory
 from frag_file import fragment_file
 from frag_utils import format_seconds
 
@@ -11,6 +12,10 @@ source_folder: Path = this_folder / 'input'
 archive_folder: Path = this_folder / 'input_archive'
 output_folder: Path = this_folder / 'ascii85_encoded'
 password = 'correct 🐎 🔋 staple'  # https://xkcd.com/936/
+use_archive = True  # set to False to fragment files in parallel without creating a tgz archive first
+durability = 'batch'  # one of 'none', 'batch', 'strict'
+shard_depth = 0  # set to 1 or 2 to write fragments into hash-prefix subfolders when creating very many fragments
+session_folders = False  # set to True to write each run's fragments into its own subfolder
 
 if __name__ == '__main__':
     # create folder to place input files and folders
@@ -33,29 +38,43 @@ if __name__ == '__main__':
         archive_date = datetime.datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
         archive_path = output_folder / f'{archive_date}.tgz'
 
-        # should never clash since we're using datetime
-        if archive_path.exists():
-            print(f'<{archive_path}> already exists, will remove...')
-            archive_path.unlink()
+        # where to write the fragments
+        fragment_folder = output_folder / archive_date if session_folders else output_folder
 
         t = time.time()
 
-        # archive everything into a gzip file
-        print(f'temporarily archiving <{source_folder}> to <{archive_path}>')
-        with tarfile.open(archive_path, mode='w:gz') as tf:
-            tf.add(source_folder, arcname=str(archive_date))
+        # fragment each file directly, packing small files together
+        if not use_archive:
+            print(f'fragmenting files in <{source_folder}> to <{fragment_folder}>')
+            fragment_paths = fragment_directory(source_folder, fragment_folder, password=password,
+                                                path_prefix=archive_date, verbose=True, durability=durability,
+                                                shard_depth=shard_depth)
 
-        print(f'elapsed: {format_seconds(time.time() - t)} ')
+            print(f'elapsed: {format_seconds(time.time() - t)}')
 
-        # plaintext fragmentation (size determined by defaults)
-        print(f'fragmenting <{archive_path}> to <{output_folder}>')
-        fragment_paths = fragment_file(archive_path, output_folder, password=password, verbose=True)
+        else:
+            # should never clash since we're using datetime
+            if archive_path.exists():
+                print(f'<{archive_path}> already exists, will remove...')
+                archive_path.unlink()
 
-        print(f'elapsed: {format_seconds(time.time() - t)}')
+            # archive everything into a gzip file
+            print(f'temporarily archiving <{source_folder}> to <{archive_path}>')
+            with tarfile.open(archive_path, mode='w:gz') as tf:
+                tf.add(source_folder, arcname=str(archive_date))
+
+            print(f'elapsed: {format_seconds(time.time() - t)} ')
 
-        # remove gzip file
-        print(f'deleting temp archive <{archive_path}>')
-        archive_path.unlink()
+            # plaintext fragmentation (size determined by defaults)
+            print(f'fragmenting <{archive_path}> to <{fragment_folder}>')
+            fragment_paths = fragment_file(archive_path, fragment_folder, password=password, verbose=True,
+                                           durability=durability, shard_depth=shard_depth)
+
+            print(f'elapsed: {format_seconds(time.time() - t)}')
+
+            # remove gzip file
+            print(f'deleting temp archive <{archive_path}>')
+            archive_path.unlink()
 
         # create folder in which to archive the entire input folder
         if not archive_folder.exists():
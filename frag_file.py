@@ -2,67 +2,346 @@
 fragment a file into multiple smaller ascii files
 """
 import codecs
-import hashlib
+import functools
 import json
+import os
 import random
+import shutil
 import time
 import warnings
 from base64 import a85decode
 from base64 import a85encode
+from concurrent.futures import ProcessPoolExecutor
 from os import urandom
 from pathlib import Path
+from pathlib import PurePosixPath
+from typing import Callable
+from typing import Dict
 from typing import Generator
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
 
 from frag_rc4 import rc4
+from frag_utils import DurableWriter
+from frag_utils import READ_BUFFER_SIZE
+from frag_utils import RECEIPTS_FILE_NAME
+from frag_utils import a85_capacity
+from frag_utils import a85_encoded_size
 from frag_utils import format_bytes
 from frag_utils import hash_content
 from frag_utils import hash_file
 from frag_utils import key_derivation_function
+from frag_utils import new_hash
+from frag_utils import read_receipts
+from frag_utils import verify_file
+from frag_utils import write_receipts
 
-MAGIC_STRING = 'text/fragment+a85+rc4+ver4'  # follow mime type convention approximately because why not
-HASH_FUNCTION = 'sha1'  # or any of {'md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512'}
+MAGIC_STRING = 'text/fragment+a85+rc4+ver5'  # follow mime type convention approximately because why not
+READABLE_MAGIC_STRINGS = (MAGIC_STRING,
+                          'text/fragment+a85+rc4+ver4',  # before file_path, packed_files and hash_function
+                          )
+HASH_FUNCTION = 'sha1'  # default, or any of frag_utils.HASH_FUNCTIONS (see frag_benchmark.py)
 
 
-def fragment_file(file_path: Path,
-                  output_dir: Path,
-                  password: Optional[str] = None,
-                  max_size: int = 22000000,
-                  size_range: int = 4000000,
-                  verbose: bool = False
-                  ) -> List[Path]:
+def _unique_salt_and_iv(seen_password_salts: Set[Optional[bytes]],
+                        seen_initialization_vectors: Set[Optional[bytes]],
+                        ) -> Tuple[bytes, bytes]:
     """
-    see TextFragment for details
+    generate a random salt and IV that haven't been used before
     """
-    # sanity checks
-    assert file_path.exists(), f'input file does not exist at {file_path}'
-    assert 0 <= size_range < max_size, f'size_range ({size_range}) must be less than max_size ({max_size})'
+    # generate random unique salt
+    password_salt = None
+    while password_salt in seen_password_salts:
+        password_salt = urandom(512)  # minimum length = 256 bytes (match rc4 keylen)
+    seen_password_salts.add(password_salt)
+
+    # generate random unique initialization vector
+    initialization_vector = None
+    while initialization_vector in seen_initialization_vectors:
+        initialization_vector = urandom(16)  # match rc4 IV len = 16 bytes
+    seen_initialization_vectors.add(initialization_vector)
+
+    return password_salt, initialization_vector
+
+
+def _encode_fragment(fragment_raw: bytes,
+                     header: dict,
+                     password: Optional[str],
+                     password_salt: bytes,
+                     initialization_vector: bytes,
+                     ) -> Tuple[str, str, bytes, bytes]:
+    """
+    hash, encrypt and a85-encode a single fragment (no file io, so this can run in any executor)
+    the fragment hash, fragment size, salt and IV are added to the header
 
-    # make sure it's an int so `random.randint` doesn't break
-    max_size = int(max_size)
-    min_size = int(max_size - size_range)
+    :return: fragment hash, fragment name, magic string and header lines, a85-encoded content
+    """
+    # hash data
+    fragment_hash = hash_content(fragment_raw, header['hash_function'])
+
+    # encrypt data if password was provided (even if password is an empty string)
+    if password is not None:
+        # rc4 takes at most 256 bytes as an encryption key
+        password_bytes = key_derivation_function(password, salt=password_salt, length=256)
+        fragment_encrypted = rc4(fragment_raw, password_bytes, initialization_vector=initialization_vector)
+
+    # don't encrypt data if password was not provided (salt and IV generated and saved but not used)
+    else:
+        fragment_encrypted = fragment_raw
+
+    # generate json header
+    header = dict(header)
+    header['fragment_hash'] = fragment_hash
+    header['fragment_size'] = len(fragment_raw)
+
+    # name the fragment after its header (except the random salt and IV) rather than just its content,
+    # so identical content from a different file or offset can never overwrite this fragment
+    fragment_name = hash_content(json.dumps(header, sort_keys=True).encode('ascii'), header['hash_function'])
+
+    header['initialization_vector'] = codecs.encode(initialization_vector, 'hex_codec').decode('ascii').upper()
+    header['password_salt'] = codecs.encode(password_salt, 'hex_codec').decode('ascii').upper()
+    header = json.dumps(header, separators=(',', ':'))  # ensure_ascii escapes any non-ascii paths
+
+    # ascii bytes, no need to go through a text encoder
+    header_lines = MAGIC_STRING.encode('ascii') + b'\n' + header.encode('ascii') + b'\n'
+    return fragment_hash, fragment_name, header_lines, a85encode(fragment_encrypted)
+
+
+def _fragment_path(output_dir: Path,
+                   fragment_name: str,
+                   shard_depth: int = 0,
+                   ) -> Path:
+    """
+    fragments are named after a hash (see _encode_fragment), optionally in nested subdirs named after its prefixes
+    e.g. with shard_depth=2, fragment ABCDEF... is written to output_dir/AB/CD/ABCDEF....txt
+    """
+    assert 0 <= shard_depth <= 4, f'shard_depth ({shard_depth}) should be between 0 and 4'
+    shard_dirs = [fragment_name[idx * 2:idx * 2 + 2] for idx in range(shard_depth)]
+    return output_dir.joinpath(*shard_dirs, f'{fragment_name}.txt')
+
+
+def _write_fragment(output_dir: Path,
+                    writer: DurableWriter,
+                    fragment_name: str,
+                    header_lines: bytes,
+                    fragment_encoded: bytes,
+                    shard_depth: int = 0,
+                    ) -> Path:
+    """
+    write an encoded fragment to a text file named after fragment_name
+    """
+    fragment_path = _fragment_path(output_dir, fragment_name, shard_depth)
+    if shard_depth:
+        writer.mkdir(fragment_path.parent)
+    with writer.open(fragment_path, '.tempfile') as f_out:
+        f_out.write(header_lines)
+        f_out.write(fragment_encoded)
+        f_out.write(b'\n')
+
+    return fragment_path
+
+
+def _fragment_overhead(header: dict) -> int:
+    """
+    upper bound on the bytes in a fragment file that are not a85 content (magic string, header, newlines)
+    header values should be as wide as possible, e.g. use file_size for fragment_start
+    """
+    header = dict(header)
+    header['initialization_vector'] = '0' * 32  # 16 bytes as hex, see _unique_salt_and_iv
+    header['password_salt'] = '0' * 1024  # 512 bytes as hex, see _unique_salt_and_iv
+    return len(MAGIC_STRING) + len(json.dumps(header, separators=(',', ':'))) + 3  # 3 newlines
+
+
+def _split_sizes(total_size: int,
+                 max_size: int,
+                 size_range: int,
+                 fragment_count: Optional[int] = None,
+                 ) -> List[int]:
+    """
+    split total_size into the fewest fragments of at most max_size (or fragment_count, if that is more)
+    each size is randomly chosen within size_range of an even split, as long as the rest can still fit
+    the spread is also capped at a quarter of the even split, so that forcing more (and hence smaller) fragments
+    with fragment_count still gives roughly even sizes instead of a few tiny fragments and one huge one
+    """
+    num_fragments = max(-(-total_size // max_size), fragment_count or 0)
+    assert num_fragments <= total_size, f'cannot split {total_size} bytes into {num_fragments} fragments'
 
-    # allocate fragment sizes greedily and randomly
-    file_size = file_path.stat().st_size
-    unallocated_bytes = file_size
     fragment_sizes = []
-    while unallocated_bytes > max_size:
-        fragment_size = random.randint(min_size, max_size)  # min_size <= fragment_size <= max_size
+    unallocated_bytes = total_size
+    for remaining_fragments in range(num_fragments, 0, -1):
+        # must leave enough for the other fragments, but at least one byte each
+        lower_bound = max(1, unallocated_bytes - (remaining_fragments - 1) * max_size)
+        upper_bound = min(max_size, unallocated_bytes - (remaining_fragments - 1))
+
+        # randomize around an even split
+        even_split = -(-unallocated_bytes // remaining_fragments)
+        spread = min(size_range, even_split // 4)
+        fragment_size = random.randint(max(lower_bound, even_split - spread // 2),
+                                       min(upper_bound, even_split + spread // 2))
         fragment_sizes.append(fragment_size)
         unallocated_bytes -= fragment_size
-    if unallocated_bytes:
-        fragment_sizes.append(unallocated_bytes)
-    assert sum(fragment_sizes) == file_size
+
+    assert sum(fragment_sizes) == total_size
     random.shuffle(fragment_sizes)  # otherwise the smallest fragment is always at the end
+    return fragment_sizes
+
+
+def plan_fragment_sizes(file_size: int,
+                        max_size: int = 22000000,
+                        size_range: int = 4000000,
+                        overhead: int = 0,
+                        max_encoded_size: Optional[int] = None,
+                        fragment_count: Optional[int] = None,
+                        batch_quota: Optional[int] = None,
+                        ) -> List[int]:
+    """
+    plan the fewest fragments that stay within every limit
+
+    :param file_size: raw bytes to split
+    :param max_size: max raw bytes per fragment
+    :param size_range: how much fragment sizes may randomly vary (0 for equal sizes),
+                       at most a quarter of the even split so that fragment_count and batch_quota stay near-even
+    :param overhead: bytes per fragment file that are not a85 content (see _fragment_overhead)
+    :param max_encoded_size: max bytes per fragment file (after a85 encoding and including the header)
+    :param fragment_count: create at least this many fragments
+    :param batch_quota: max total bytes of fragment files per transfer batch,
+                        fragments are returned in order such that consecutive fragments fill each batch
+    :return: raw size of each fragment
+    """
+    assert 0 <= size_range < max_size, f'size_range ({size_range}) must be less than max_size ({max_size})'
+    assert fragment_count is None or batch_quota is None, 'cannot use both fragment_count and batch_quota'
+
+    # make sure it's an int so `random.randint` doesn't break
+    max_size = int(max_size)
+    size_range = int(size_range)
+
+    # convert the encoded size limit to a raw size limit
+    if max_encoded_size is not None:
+        max_size = min(max_size, a85_capacity(max_encoded_size - overhead))
+        assert max_size > 0, f'max_encoded_size ({max_encoded_size}) must exceed the overhead ({overhead})'
+        size_range = min(size_range, max_size - 1)
+
+    # nothing to do
+    if not file_size:
+        return []
+
+    if batch_quota is None:
+        return _split_sizes(file_size, max_size, size_range, fragment_count)
+
+    # find the number of fragments that fits the most bytes into one batch
+    # a85 encoding is at most 5/4 of the raw size plus 1 byte per fragment, so this is conservative
+    batch_capacity = 0
+    num_fragments = 1
+    while num_fragments * (overhead + 2) <= batch_quota:
+        capacity = min(num_fragments * max_size, a85_capacity(batch_quota - num_fragments * (overhead + 1)))
+        if capacity <= batch_capacity:
+            break
+        batch_capacity = capacity
+        num_fragments += 1
+    assert batch_capacity > 0, f'batch_quota ({batch_quota}) must exceed the overhead ({overhead})'
+
+    # fill each batch in turn
+    fragment_sizes = []
+    unallocated_bytes = file_size
+    while unallocated_bytes:
+        batch_sizes = _split_sizes(min(unallocated_bytes, batch_capacity), max_size, size_range)
+        assert sum(overhead + a85_encoded_size(size) for size in batch_sizes) <= batch_quota
+        fragment_sizes.extend(batch_sizes)
+        unallocated_bytes -= sum(batch_sizes)
+    return fragment_sizes
+
+
+def _plan_fragments(file_path: Path,
+                    max_size: int,
+                    size_range: int,
+                    relative_path: Optional[str],
+                    hash_func: str,
+                    max_encoded_size: Optional[int],
+                    fragment_count: Optional[int],
+                    batch_quota: Optional[int],
+                    duplicate_paths: Optional[List[str]] = None,
+                    file_hash: Optional[str] = None,
+                    ) -> Tuple[dict, List[int]]:
+    """
+    hash the input file (unless its file_hash is already known) and plan its fragments
+
+    :return: header values shared by all fragments, size of each fragment
+    """
+    # sanity checks
+    assert file_path.exists(), f'input file does not exist at {file_path}'
+    assert 0 <= size_range < max_size, f'size_range ({size_range}) must be less than max_size ({max_size})'
+    assert not duplicate_paths or relative_path is not None, 'duplicate_paths requires relative_path'
 
     # get static values used in header info
-    file_name = file_path.name
-    file_hash = hash_file(file_path, hash_func=HASH_FUNCTION)
+    file_size = file_path.stat().st_size
+    hash_func = hash_func.strip().lower()
+    if file_hash is None:
+        file_hash = hash_file(file_path, hash_func=hash_func)
+    if relative_path is not None:
+        file_header = {'file_path': PurePosixPath(relative_path).as_posix()}
+        if duplicate_paths:
+            file_header['duplicate_paths'] = [PurePosixPath(path).as_posix() for path in duplicate_paths]
+    else:
+        file_header = {'file_name': file_path.name.encode('idna').decode('ascii')}
+    file_header.update({'hash_function': hash_func,
+                        'file_hash':     file_hash,
+                        'file_size':     file_size,
+                        })
+
+    # allocate fragment sizes, the widest possible header is used to bound the overhead
+    overhead = _fragment_overhead(dict(file_header,
+                                       fragment_start=file_size,
+                                       fragment_hash=file_hash,
+                                       fragment_size=file_size))
+    fragment_sizes = plan_fragment_sizes(file_size,
+                                         max_size=max_size,
+                                         size_range=size_range,
+                                         overhead=overhead,
+                                         max_encoded_size=max_encoded_size,
+                                         fragment_count=fragment_count,
+                                         batch_quota=batch_quota)
+    return file_header, fragment_sizes
+
+
+def fragment_file(file_path: Path,
+                  output_dir: Path,
+                  password: Optional[str] = None,
+                  max_size: int = 22000000,
+                  size_range: int = 4000000,
+                  verbose: bool = False,
+                  relative_path: Optional[str] = None,
+                  durability: str = 'none',
+                  hash_func: str = HASH_FUNCTION,
+                  max_encoded_size: Optional[int] = None,
+                  fragment_count: Optional[int] = None,
+                  batch_quota: Optional[int] = None,
+                  shard_depth: int = 0,
+                  duplicate_paths: Optional[List[str]] = None,
+                  file_hash: Optional[str] = None,
+                  ) -> List[Path]:
+    """
+    see TextFragment for details
+    see plan_fragment_sizes for max_encoded_size, fragment_count and batch_quota
+    see _fragment_path for shard_depth (use 1 or 2 for very large numbers of fragments)
+
+    if relative_path is given, it is stored in the header (as file_path) instead of the file name,
+    so that the file can be restored into a subdirectory of the output dir
+    duplicate_paths are other relative paths with identical content, which are restored as copies of this file
+
+    durability is one of 'none', 'batch' or 'strict' (see DurableWriter)
+    hash_func is recorded in the header, so decoding uses the same hash function
+    file_hash can be given if the file was already hashed with hash_func, so that it isn't read twice
+    """
+    file_header, fragment_sizes = _plan_fragments(file_path, max_size, size_range, relative_path, hash_func,
+                                                  max_encoded_size, fragment_count, batch_quota, duplicate_paths,
+                                                  file_hash)
     if verbose:
         print(f'fragmentation target path is <{file_path}>')
-        print(f'fragmentation target hash is {file_hash}')
-        print(f'fragmentation target size is {format_bytes(file_size)}')
+        print(f'fragmentation target hash is {file_header["file_hash"]}')
+        print(f'fragmentation target size is {format_bytes(file_header["file_size"])}')
         print(f'creating {len(fragment_sizes)} fragments...')
 
     # create output folder
@@ -74,7 +353,7 @@ def fragment_file(file_path: Path,
     fragment_paths = []
     seen_password_salts = {None}
     seen_initialization_vectors = {None, b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'}
-    with file_path.open('rb') as f_in:
+    with file_path.open('rb') as f_in, DurableWriter(durability) as writer:
         for fragment_idx, fragment_size in enumerate(fragment_sizes):
             # get start byte
             fragment_start = f_in.tell()
@@ -83,61 +362,23 @@ def fragment_file(file_path: Path,
             fragment_raw = f_in.read(fragment_size)
             assert len(fragment_raw) == fragment_size, f'could not read file, may have been modified'
 
-            # hash data
-            fragment_hash = hash_content(fragment_raw, HASH_FUNCTION)
-
-            # generate random unique salt
-            password_salt = None
-            while password_salt in seen_password_salts:
-                password_salt = urandom(512)  # minimum length = 256 bytes (match rc4 keylen)
-
-            # generate random unique initialization vector
-            initialization_vector = None
-            while initialization_vector in seen_initialization_vectors:
-                initialization_vector = urandom(16)  # match rc4 IV len = 16 bytes
-
-            # encrypt data if password was provided (even if password is an empty string)
-            if password is not None:
-                # rc4 takes at most 256 bytes as an encryption key
-                password_bytes = key_derivation_function(password, salt=password_salt, length=256)
-                fragment_encrypted = rc4(fragment_raw, password_bytes, initialization_vector=initialization_vector)
-
-            # don't encrypt data if password was not provided (salt and IV generated and saved but not used)
-            else:
-                fragment_encrypted = fragment_raw
+            # hash, encrypt and encode data
+            password_salt, initialization_vector = _unique_salt_and_iv(seen_password_salts,
+                                                                       seen_initialization_vectors)
+            fragment_hash, fragment_name, header_lines, fragment_encoded = _encode_fragment(
+                fragment_raw,
+                dict(file_header, fragment_start=fragment_start),
+                password,
+                password_salt,
+                initialization_vector)
 
             if verbose:
                 print(f'fragment [{fragment_idx + 1}/{len(fragment_sizes)}] {fragment_hash}'
                       f' -> {format_bytes(fragment_size)} from byte {fragment_start}')
 
-            # generate json header
-            initialization_vector_hex = codecs.encode(initialization_vector, 'hex_codec').decode('ascii').upper()
-            password_salt_hex = codecs.encode(password_salt, 'hex_codec').decode('ascii').upper()
-            header = json.dumps({'file_name':             file_name.encode('idna').decode('ascii'),
-                                 'file_hash':             file_hash,
-                                 'file_size':             file_size,
-                                 'fragment_start':        fragment_start,
-                                 'fragment_hash':         fragment_hash,
-                                 'fragment_size':         fragment_size,
-                                 'initialization_vector': initialization_vector_hex,
-                                 'password_salt':         password_salt_hex,
-                                 }, separators=(',', ':'))
-
             # write fragment file
-            fragment_path = output_dir / f'{fragment_hash}.txt'
-            fragment_tmp_path = output_dir / f'{fragment_hash}.txt.tempfile'
-            fragment_paths.append(fragment_path)
-            try:
-                with fragment_tmp_path.open(mode='wt', encoding='ascii', newline='\n') as f_out:
-                    f_out.write(MAGIC_STRING + '\n')
-                    f_out.write(header + '\n')
-                    f_out.write(a85encode(fragment_encrypted).decode('ascii') + '\n')
-                fragment_tmp_path.rename(fragment_path)
-
-            except Exception:
-                if fragment_tmp_path.exists():
-                    fragment_tmp_path.unlink()
-                raise
+            fragment_paths.append(_write_fragment(output_dir, writer, fragment_name, header_lines, fragment_encoded,
+                                                  shard_depth))
 
         # make sure the entire file has been processed
         assert len(f_in.read()) == 0, f'file may have been modified during processing!'
@@ -146,35 +387,290 @@ def fragment_file(file_path: Path,
     return fragment_paths
 
 
+def _fragment_pack(packed_paths: List[Tuple[Optional[Path], str]],
+                   output_dir: Path,
+                   password: Optional[str] = None,
+                   verbose: bool = False,
+                   durability: str = 'none',
+                   hash_func: str = HASH_FUNCTION,
+                   shard_depth: int = 0,
+                   ) -> List[Path]:
+    """
+    concatenate many small files into a single fragment
+    the header lists the relative path, hash, size and start byte of each file within the pack
+    identical files within the pack are only packed once, and the other paths are stored as duplicate_paths
+    packed_paths with no file path are empty dirs, which are listed in the header as empty_dirs
+    """
+    hash_func = hash_func.strip().lower()
+    pack_content = bytearray()
+    packed_files = []
+    packed_hashes = dict()  # file hash -> packed_files entry
+    empty_dirs = []
+    for file_path, relative_path in packed_paths:
+        if file_path is None:
+            empty_dirs.append(PurePosixPath(relative_path).as_posix())
+            continue
+
+        file_content = file_path.read_bytes()
+        file_hash = hash_content(file_content, hash_func)
+        if file_hash in packed_hashes:
+            packed_hashes[file_hash].setdefault('duplicate_paths', []).append(PurePosixPath(relative_path).as_posix())
+            continue
+
+        packed_files.append({'file_path':  PurePosixPath(relative_path).as_posix(),
+                             'file_hash':  file_hash,
+                             'file_size':  len(file_content),
+                             'pack_start': len(pack_content),
+                             })
+        packed_hashes[file_hash] = packed_files[-1]
+        pack_content += file_content
+
+    # the pack is treated as a single-fragment file
+    pack_hash = hash_content(pack_content, hash_func)
+    if verbose:
+        print(f'packing {len(packed_files)} files -> {format_bytes(len(pack_content))} as {pack_hash}')
+
+    # create output folder
+    output_dir = output_dir.resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    assert output_dir.is_dir()
+
+    header = {'hash_function':  hash_func,
+              'file_hash':      pack_hash,
+              'file_size':      len(pack_content),
+              'fragment_start': 0,
+              'packed_files':   packed_files,
+              }
+    if empty_dirs:
+        header['empty_dirs'] = empty_dirs
+    password_salt, initialization_vector = _unique_salt_and_iv({None}, {None, bytes(16)})
+    _, fragment_name, header_lines, fragment_encoded = _encode_fragment(bytes(pack_content),
+                                                                        header,
+                                                                        password,
+                                                                        password_salt,
+                                                                        initialization_vector)
+    with DurableWriter(durability) as writer:
+        fragment_path = _write_fragment(output_dir, writer, fragment_name, header_lines, fragment_encoded,
+                                        shard_depth)
+    return [fragment_path]
+
+
+def fragment_directory(input_dir: Path,
+                       output_dir: Path,
+                       password: Optional[str] = None,
+                       max_size: int = 22000000,
+                       size_range: int = 4000000,
+                       pack_size: int = 1000000,
+                       path_prefix: Optional[str] = None,
+                       workers: Optional[int] = None,
+                       verbose: bool = False,
+                       durability: str = 'none',
+                       hash_func: str = HASH_FUNCTION,
+                       max_encoded_size: Optional[int] = None,
+                       shard_depth: int = 0,
+                       ) -> List[Path]:
+    """
+    fragment every file in a directory tree without creating an intermediate archive
+    files smaller than pack_size are packed together into shared fragments of at most max_size bytes
+    larger files are fragmented independently across a pool of worker processes
+    the relative path of each file (under path_prefix, if given) is stored in the fragment headers
+    identical large files are only fragmented once (see _find_duplicates), as are identical files in the same pack
+    empty dirs are stored in the pack headers, but timestamps and permissions are not kept
+    if max_encoded_size is given, no fragment file (including packs) will be larger than that
+    """
+    # sanity checks
+    assert input_dir.is_dir(), f'input dir does not exist at {input_dir}'
+    assert 0 <= pack_size <= max_size, f'pack_size ({pack_size}) must not exceed max_size ({max_size})'
+
+    # widest possible pack header, to bound the overhead of packed fragments
+    hash_width = len(new_hash(hash_func).hexdigest())
+    pack_overhead = _fragment_overhead({'hash_function':  hash_func.strip().lower(),
+                                        'file_hash':      '0' * hash_width,
+                                        'file_size':      max_size,
+                                        'fragment_start': 0,
+                                        'fragment_hash':  '0' * hash_width,
+                                        'fragment_size':  max_size,
+                                        'packed_files':   [],
+                                        'empty_dirs':     [],
+                                        })
+
+    def pack_fits(num_bytes: int, overhead: int) -> bool:
+        if max_encoded_size is None:
+            return num_bytes <= max_size
+        return num_bytes <= max_size and overhead + a85_encoded_size(num_bytes) <= max_encoded_size
+
+    # walk the input tree
+    input_dir = input_dir.resolve()
+    large_files_by_size = dict()
+    packs = [[]]
+    pack_bytes = 0
+    pack_overheads = pack_overhead
+    empty_dirs = []
+    for file_path in sorted(input_dir.rglob('*')):
+        relative_path = file_path.relative_to(input_dir).as_posix()
+        if path_prefix is not None:
+            relative_path = f'{path_prefix}/{relative_path}'
+
+        # empty dirs are recreated from the pack headers, other dirs are recreated along with their files
+        if file_path.is_dir():
+            if not any(file_path.iterdir()):
+                empty_dirs.append(relative_path)
+            continue
+        if not file_path.is_file():
+            continue
+        file_size = file_path.stat().st_size
+
+        # bytes this file adds to the pack header (an identical file in the same pack adds fewer)
+        entry_overhead = 1 + len(json.dumps({'file_path':  relative_path,
+                                             'file_hash':  '0' * hash_width,
+                                             'file_size':  file_size,
+                                             'pack_start': max_size,
+                                             }, separators=(',', ':')))
+
+        # large files get their own fragments (empty files must be packed, since they have no fragments)
+        if file_size and (file_size >= pack_size or not pack_fits(file_size, pack_overhead + entry_overhead)):
+            large_files_by_size.setdefault(file_size, []).append((file_path, relative_path))
+            continue
+
+        # small files are packed greedily in path order
+        if packs[-1] and not pack_fits(pack_bytes + file_size, pack_overheads + entry_overhead):
+            packs.append([])
+            pack_bytes = 0
+            pack_overheads = pack_overhead
+        packs[-1].append((file_path, relative_path))
+        pack_bytes += file_size
+        pack_overheads += entry_overhead
+
+    # empty dirs take up header space in whichever pack has room
+    for relative_path in empty_dirs:
+        entry_overhead = 1 + len(json.dumps(relative_path))
+        if packs[-1] and not pack_fits(pack_bytes, pack_overheads + entry_overhead):
+            packs.append([])
+            pack_bytes = 0
+            pack_overheads = pack_overhead
+        packs[-1].append((None, relative_path))
+        pack_overheads += entry_overhead
+
+    packs = [pack for pack in packs if pack]
+    if verbose:
+        print(f'fragmenting {sum(map(len, large_files_by_size.values()))} large files'
+              f' and {sum(map(len, packs)) - len(empty_dirs)} small files (in {len(packs)} packs)'
+              f' from <{input_dir}>')
+
+    # run everything in the current process if only one worker is requested
+    if workers == 1:
+        fragment_paths = []
+        large_files = _find_duplicates(large_files_by_size, hash_func, map, verbose)
+        for _, file_path, relative_path, duplicate_paths, file_hash in large_files:
+            fragment_paths.extend(fragment_file(file_path, output_dir, password, max_size, size_range, verbose,
+                                                relative_path=relative_path, durability=durability,
+                                                hash_func=hash_func, max_encoded_size=max_encoded_size,
+                                                shard_depth=shard_depth, duplicate_paths=duplicate_paths,
+                                                file_hash=file_hash))
+        for pack in packs:
+            fragment_paths.extend(_fragment_pack(pack, output_dir, password, verbose,
+                                                 durability=durability, hash_func=hash_func,
+                                                 shard_depth=shard_depth))
+        return fragment_paths
+
+    # rc4 is pure python, so use processes rather than threads
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        large_files = _find_duplicates(large_files_by_size, hash_func, executor.map, verbose)
+        futures = [executor.submit(fragment_file, file_path, output_dir, password, max_size, size_range, verbose,
+                                   relative_path=relative_path, durability=durability,
+                                   hash_func=hash_func, max_encoded_size=max_encoded_size,
+                                   shard_depth=shard_depth, duplicate_paths=duplicate_paths, file_hash=file_hash)
+                   for _, file_path, relative_path, duplicate_paths, file_hash in large_files]
+        futures.extend(executor.submit(_fragment_pack, pack, output_dir, password, verbose,
+                                       durability=durability, hash_func=hash_func, shard_depth=shard_depth)
+                       for pack in packs)
+        return [fragment_path for future in futures for fragment_path in future.result()]
+
+
+def _find_duplicates(files_by_size: Dict[int, List[Tuple[Path, str]]],
+                     hash_func: str,
+                     map_func: Callable[[Callable, Iterable], Iterable],
+                     verbose: bool = False,
+                     ) -> List[Tuple[int, Path, str, List[str], Optional[str]]]:
+    """
+    find identical files, which must not be fragmented more than once
+    only files that share their size with another file are hashed, in parallel if map_func is a pool's map
+
+    :return: list of (file size, file path, relative path, duplicate paths, file hash or None if not hashed),
+             largest files first so a pool isn't left waiting on one big file at the end
+    """
+    unique_files = [(file_size, file_path, relative_path, [], None)
+                    for file_size, same_size_files in files_by_size.items() if len(same_size_files) == 1
+                    for file_path, relative_path in same_size_files]
+
+    # hash the rest, and group them by content
+    same_size_files = [(file_size, file_path, relative_path)
+                       for file_size, same_size_files in files_by_size.items() if len(same_size_files) > 1
+                       for file_path, relative_path in same_size_files]
+    file_hashes = map_func(functools.partial(hash_file, hash_func=hash_func.strip().lower()),
+                           [file_path for _, file_path, _ in same_size_files])
+    files_by_hash = dict()
+    for (file_size, file_path, relative_path), file_hash in zip(same_size_files, file_hashes):
+        files_by_hash.setdefault((file_size, file_hash), []).append((file_path, relative_path))
+    for (file_size, file_hash), ((file_path, relative_path), *duplicates) in files_by_hash.items():
+        unique_files.append((file_size, file_path, relative_path, [path for _, path in duplicates], file_hash))
+
+    if verbose:
+        num_duplicates = sum(len(duplicate_paths) for _, _, _, duplicate_paths, _ in unique_files)
+        if num_duplicates:
+            print(f'skipping {num_duplicates} identical copies, which will be restored from the same fragments')
+
+    unique_files.sort(key=lambda x: (-x[0], x[2]))
+    return unique_files
+
 class TextFragment:
     """
     parse a fragment.txt file which has three lines of ascii
-    1st line is the MAGIC_STRING
+    1st line is the MAGIC_STRING (or any of the READABLE_MAGIC_STRINGS)
     2nd line is a json header
     3rd line is base64-encoded binary content
     
     json-header:
         file_name:              <file name> (base64)
+        file_path:              <relative file path> (replaces file_name when fragmenting a directory)
+        duplicate_paths:        <relative paths of identical copies of the file> (only if there are any)
+        hash_function:          <name of hash function> (defaults to sha1 if missing)
         file_hash:              <file hash> (base64)
         file_size:              <file size> (int)
         fragment_start:         <first byte of fragment data>
         fragment_hash:          <fragment hash> (base64)
         fragment_size:          <fragment size> (int)
+        packed_files:           <list of file_path, file_hash, file_size, pack_start, duplicate_paths>
+                                (only for packed fragments, duplicate_paths only if there are any)
+        empty_dirs:             <relative paths of empty dirs> (only for packed fragments, if there are any)
         initialization_vector:  <initialization vector> (base64)
+
+    packed fragments have neither file_name nor file_path
     """
 
-    def __init__(self, fragment_path: Path, password: Optional[str] = None):
+    def __init__(self, fragment_path: Path, password: Optional[str] = None, root_dir: Optional[Path] = None):
+        """
+        :param root_dir: the folder that was searched for fragments, see unlink
+        """
         self.fragment_path = fragment_path
         self.password = password
+        self.root_dir = root_dir
 
         # verify magic string and read header
         with fragment_path.open(mode='rt', encoding='ascii') as f:
-            assert f.readline().strip() == MAGIC_STRING
+            assert f.readline().strip() in READABLE_MAGIC_STRINGS
             header = json.loads(f.readline())
             self.content_pos = f.tell()
 
         # parse header
-        self.file_name: str = header['file_name'].encode('ascii').decode('idna')
+        if 'file_path' in header:
+            self.file_name: Optional[str] = header['file_path']
+        elif 'file_name' in header:
+            self.file_name: Optional[str] = header['file_name'].encode('ascii').decode('idna')
+        else:
+            self.file_name: Optional[str] = None  # packed fragment
+        self.duplicate_paths: List[str] = header.get('duplicate_paths', [])
+        self.hash_function: str = header.get('hash_function', 'sha1')  # older fragments were always sha1
         self.file_hash: str = header['file_hash']
         self.file_size: int = header['file_size']
         self.fragment_start: int = header['fragment_start']
@@ -182,25 +678,43 @@ class TextFragment:
         self.fragment_size: int = header['fragment_size']
         self.initialization_vector: bytes = codecs.decode(header['initialization_vector'].encode('ascii'), 'hex_codec')
         self.password_salt: bytes = codecs.decode(header['password_salt'].encode('ascii'), 'hex_codec')
+        self.packed_files: Optional[List[dict]] = header.get('packed_files')
+        self.empty_dirs: List[str] = header.get('empty_dirs', [])
 
     def read(self, length=None):
         """
         get decoded raw content of fragment
         :return: content (bytes)
         """
-        # sanity check
-        if length is None:
-            length = self.fragment_size
-        assert length <= self.fragment_size
+        return self.decode(self.read_encoded(), length)
 
-        with self.fragment_path.open(mode='rt', encoding='ascii') as f:
-            # read and decode content to bytes
+    def read_encoded(self) -> bytes:
+        """
+        get a85-encoded content of fragment (file io only)
+        :return: encoded content (bytes)
+        """
+        with self.fragment_path.open(mode='rb') as f:
             f.seek(self.content_pos)
-            content = a85decode(f.readline().rstrip())
+            encoded = f.readline().rstrip()
 
             # nothing left behind
             assert not f.read().strip()
 
+        return encoded
+
+    def decode(self, encoded: bytes, length=None) -> bytes:
+        """
+        decode, decrypt and verify content from read_encoded (no file io)
+        :return: content (bytes)
+        """
+        # sanity check
+        if length is None:
+            length = self.fragment_size
+        assert length <= self.fragment_size
+
+        # decode content to bytes
+        content = a85decode(encoded)
+
         # decrypt data
         if self.password is not None:
             password_bytes = key_derivation_function(self.password, salt=self.password_salt, length=256)
@@ -208,14 +722,14 @@ class TextFragment:
 
         # verify content
         assert self.fragment_size == len(content)
-        assert self.fragment_hash == hash_content(content, hash_func=HASH_FUNCTION)
+        assert self.fragment_hash == hash_content(content, hash_func=self.hash_function)
 
         # return as many bytes as requested
         return content[:length]
 
     def unlink(self):
         """
-        delete source file
+        delete source file, and any parent folders this leaves empty (e.g. shard folders) up to root_dir
         """
         for retry in range(3):
             if self.fragment_path.exists():
@@ -230,6 +744,17 @@ class TextFragment:
                     pass
         if self.fragment_path.exists():
             warnings.warn(f'unable to delete fragment at path {self.fragment_path}')
+            return
+
+        # otherwise the empty folders pile up and have to be walked on every run
+        if self.root_dir is not None:
+            for parent_dir in self.fragment_path.parents:
+                if self.root_dir not in parent_dir.parents:
+                    break
+                try:
+                    parent_dir.rmdir()
+                except OSError:  # not empty (e.g. other fragments), or in use
+                    break
 
 
 class FragmentedFile:
@@ -242,8 +767,12 @@ class FragmentedFile:
 
         # get metadata
         self.file_name = text_fragment.file_name
+        self.duplicate_paths = text_fragment.duplicate_paths
+        self.hash_function = text_fragment.hash_function
         self.file_hash = text_fragment.file_hash
         self.file_size = text_fragment.file_size
+        self.packed_files = text_fragment.packed_files
+        self.empty_dirs = text_fragment.empty_dirs
 
         # fragment storage
         self.fragments = dict()  # start byte -> [(end byte, fragment)]
@@ -259,8 +788,12 @@ class FragmentedFile:
         """
         # ensure it really is the same original file
         assert text_fragment.file_name == self.file_name
+        assert text_fragment.duplicate_paths == self.duplicate_paths
+        assert text_fragment.hash_function == self.hash_function
         assert text_fragment.file_hash == self.file_hash
         assert text_fragment.file_size == self.file_size
+        assert text_fragment.packed_files == self.packed_files
+        assert text_fragment.empty_dirs == self.empty_dirs
 
         # index text fragments by interval
         self.fragments \
@@ -315,13 +848,55 @@ class FragmentedFile:
             for _, text_fragment in fragment_set:
                 text_fragment.unlink()
 
+    def _prepare_output(self, output_dir: Path,
+                        file_name: Optional[str],
+                        overwrite: bool,
+                        verbose: bool,
+                        strict_verify: bool = False,
+                        receipts: Optional[Dict[str, dict]] = None,
+                        ) -> Tuple[Optional[Path], bool]:
+        """
+        find the output path, make its parent dir, and check if it was already extracted
+        an existing file is only rehashed if its receipt is missing or stale (or if strict_verify)
+        :return: (output path or None if skipped, whether the file needs to be written)
+        """
+        if file_name is None:
+            file_name = self.file_name
+        file_path = _output_path(output_dir, file_name)
+
+        # make parent dir (not based on output_dir because file_name can contain subdir info)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        assert file_path.parent.is_dir()
+
+        # check if already extracted to avoid overwrite
+        if file_path.exists():
+            if verify_file(file_path, self.hash_function, self.file_hash, output_dir.resolve(), strict=strict_verify,
+                           receipts=receipts):
+                if verbose:
+                    print('file already extracted successfully, exists at output path')
+                return file_path, False
+
+            if not overwrite:
+                if verbose:
+                    print('non-matching file already exists at output path, skipping')
+                warnings.warn(f'file already exists: {file_path}')
+                return None, False
+
+        return file_path, True
+
     def make_file(self, output_dir: Path,
                   file_name: Optional[str] = None,
                   remove_originals: bool = True,
                   overwrite: bool = False,
-                  verbose: bool = False
+                  verbose: bool = False,
+                  durability: str = 'none',
+                  strict_verify: bool = False,
+                  receipts: Optional[Dict[str, dict]] = None,
                   ) -> Optional[Path]:
-
+        """
+        restore the file from its fragments
+        receipts (from read_receipts on output_dir) can be passed in when restoring many files
+        """
         # which fragment_set to make from
         extraction_plan = self.get_extraction_plan()
         assert extraction_plan is not None
@@ -332,105 +907,369 @@ class FragmentedFile:
             if unused and remove_originals:
                 print(f'{unused} extra fragment(s) will also be deleted')
 
-        # where output file will be written
-        if file_name is None:
-            file_name = self.file_name
-        file_path = output_dir / file_name
-
-        # make parent dir (not based on output_dir because file_name can contain subdir info)
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        assert file_path.parent.is_dir()
-
-        # check if already extracted to avoid overwrite
-        if file_path.exists():
-            if hash_file(file_path, hash_func=HASH_FUNCTION) == self.file_hash:
+        # where output file will be written, and whether it still needs to be written
+        file_path, needs_writing = self._prepare_output(output_dir, file_name, overwrite, verbose, strict_verify,
+                                                        receipts)
+        if not needs_writing:
+            if file_path is not None and remove_originals:
+                self.remove()
+            return file_path
+
+        # start extraction (the partial file is deleted if something fails)
+        # the writer is flushed before the originals are removed, so batch mode is as safe as strict here
+        with DurableWriter(durability) as writer, writer.open(file_path, '.partial') as f:
+            # init full content hash
+            hash_obj = new_hash(self.hash_function)
+
+            # write all fragments in order and update full content hash
+            for fragment_idx, (required_length, text_fragment) in enumerate(extraction_plan):
                 if verbose:
-                    print('file already extracted successfully, exists at output path')
-                if remove_originals:
-                    self.remove()
-                return file_path
+                    print(f'reading fragment [{fragment_idx + 1}/{len(extraction_plan)}]'
+                          f' {text_fragment.fragment_hash}'
+                          f' -> {format_bytes(text_fragment.fragment_size)}'
+                          f' from byte {text_fragment.fragment_start}')
 
-            if not overwrite:
-                if verbose:
-                    print('non-matching file already exists at output path, skipping')
-                warnings.warn(f'file already exists: {file_path}')
-                return None
+                assert f.tell() == text_fragment.fragment_start
+                content = text_fragment.read(required_length)
+                hash_obj.update(content)
+                f.write(content)
+
+            # make sure full and correct file contents have been written to disk
+            assert f.tell() == self.file_size
+            assert self.file_hash == hash_obj.hexdigest().upper()
 
-        # start extraction
-        temp_path = file_path.with_suffix(file_path.suffix + '.partial')
-        try:
-            with temp_path.open('wb') as f:
-                # init full content hash
-                hash_obj = getattr(hashlib, HASH_FUNCTION)()
-
-                # write all fragments in order and update full content hash
-                for fragment_idx, (required_length, text_fragment) in enumerate(extraction_plan):
-                    if verbose:
-                        print(f'reading fragment [{fragment_idx + 1}/{len(extraction_plan)}]'
-                              f' {text_fragment.fragment_hash}'
-                              f' -> {format_bytes(text_fragment.fragment_size)}'
-                              f' from byte {text_fragment.fragment_start}')
-
-                    assert f.tell() == text_fragment.fragment_start
-                    content = text_fragment.read(required_length)
-                    hash_obj.update(content)
-                    f.write(content)
-
-                # make sure full and correct file contents have been written to disk
-                assert f.tell() == self.file_size
-                assert self.file_hash == hash_obj.hexdigest().upper()
-            temp_path.rename(file_path)
-
-        # if something failed, delete partial file
-        except Exception:
-            if temp_path.exists():
-                temp_path.unlink()
-            raise
+        # so that the next run doesn't need to rehash this file
+        write_receipts(output_dir.resolve(), self.hash_function, {file_path: self.file_hash}, receipts)
 
         # erase originals (unless otherwise specified) and return
         if remove_originals:
             self.remove()
         return file_path
 
+    def make_files(self, output_dir: Path,
+                   file_name: Optional[str] = None,
+                   remove_originals: bool = True,
+                   overwrite: bool = False,
+                   verbose: bool = False,
+                   durability: str = 'none',
+                   strict_verify: bool = False,
+                   receipts: Optional[Dict[str, dict]] = None,
+                   ) -> List[Path]:
+        """
+        restore the file and any identical copies of it (see duplicate_paths)
+        copies are not made if the file is restored to a different file_name
+        originals are only removed if every copy was restored
+        """
+        copy_files = file_name is None and bool(self.duplicate_paths)
+        file_path = self.make_file(output_dir,
+                                   file_name=file_name,
+                                   remove_originals=remove_originals and not copy_files,
+                                   overwrite=overwrite,
+                                   verbose=verbose,
+                                   durability=durability,
+                                   strict_verify=strict_verify,
+                                   receipts=receipts)
+        if file_path is None or not copy_files:
+            return [file_path] if file_path is not None else []
+
+        file_paths = [file_path] + self._make_duplicates(file_path, output_dir, overwrite, verbose, durability,
+                                                         strict_verify, receipts)
+
+        # erase originals (unless otherwise specified) and return
+        if remove_originals and len(file_paths) == 1 + len(self.duplicate_paths):
+            self.remove()
+        return file_paths
+
+    def _make_duplicates(self, source_path: Path,
+                         output_dir: Path,
+                         overwrite: bool,
+                         verbose: bool,
+                         durability: str = 'none',
+                         strict_verify: bool = False,
+                         receipts: Optional[Dict[str, dict]] = None,
+                         ) -> List[Path]:
+        """
+        copy the restored file at source_path to each of the duplicate_paths
+        :return: the paths that now hold a copy
+        """
+        file_paths = []
+        written_hashes = dict()
+        receipts_dir = output_dir.resolve()
+        if receipts is None:
+            receipts = read_receipts(receipts_dir)
+        with DurableWriter(durability) as writer:
+            for duplicate_path in self.duplicate_paths:
+                file_path = _output_path(output_dir, duplicate_path)
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                assert file_path.parent.is_dir()
+
+                # check if already extracted to avoid overwrite
+                if file_path.exists():
+                    if verify_file(file_path, self.hash_function, self.file_hash, receipts_dir,
+                                   strict=strict_verify, receipts=receipts):
+                        file_paths.append(file_path)
+                        continue
+
+                    if not overwrite:
+                        if verbose:
+                            print(f'non-matching file already exists at output path <{file_path}>, skipping')
+                        warnings.warn(f'file already exists: {file_path}')
+                        continue
+
+                # identical content, so copy the restored file instead of decoding the fragments again
+                if verbose:
+                    print(f'copying identical file to <{file_path}>')
+                with source_path.open('rb') as f_in, writer.open(file_path, '.partial') as f_out:
+                    shutil.copyfileobj(f_in, f_out, READ_BUFFER_SIZE)
+                file_paths.append(file_path)
+                written_hashes[file_path] = self.file_hash
+
+        # so that the next run doesn't need to rehash these files
+        if written_hashes:
+            write_receipts(receipts_dir, self.hash_function, written_hashes, receipts)
+        return file_paths
+
+    def make_packed_files(self, output_dir: Path,
+                          remove_originals: bool = True,
+                          overwrite: bool = False,
+                          verbose: bool = False,
+                          durability: str = 'none',
+                          strict_verify: bool = False,
+                          receipts: Optional[Dict[str, dict]] = None,
+                          ) -> List[Path]:
+        """
+        restore all the small files stored in a packed fragment (and any identical copies of them)
+        and recreate the empty dirs listed in it
+        originals are only removed if every packed file and empty dir was restored
+        """
+        # which fragment_set to make from
+        extraction_plan = self.get_extraction_plan()
+        assert extraction_plan is not None
+        assert self.packed_files is not None
+
+        if verbose:
+            print(f'unpacking {len(self.packed_files)} files ({format_bytes(self.file_size)})'
+                  f' from {len(extraction_plan)} fragments of pack {self.file_hash}')
+
+        # packs are at most one fragment in size, so just read the whole thing
+        pack_content = bytearray()
+        for required_length, text_fragment in extraction_plan:
+            assert len(pack_content) == text_fragment.fragment_start
+            pack_content += text_fragment.read(required_length)
+        assert len(pack_content) == self.file_size
+        assert self.file_hash == hash_content(pack_content, hash_func=self.hash_function)
+
+        file_paths = []
+        written_hashes = dict()
+        receipts_dir = output_dir.resolve()
+        if receipts is None:
+            receipts = read_receipts(receipts_dir)
+        with DurableWriter(durability) as writer:
+            for packed_file, packed_path in _packed_paths(self.packed_files):
+                file_path = _output_path(output_dir, packed_path)
+                file_path.parent.mkdir(parents=True, exist_ok=True)
+                assert file_path.parent.is_dir()
+
+                # verify file content
+                pack_start = packed_file['pack_start']
+                file_content = pack_content[pack_start:pack_start + packed_file['file_size']]
+                assert len(file_content) == packed_file['file_size']
+                assert packed_file['file_hash'] == hash_content(file_content, hash_func=self.hash_function)
+
+                # check if already extracted to avoid overwrite
+                if file_path.exists():
+                    if verify_file(file_path, self.hash_function, packed_file['file_hash'], receipts_dir,
+                                   strict=strict_verify, receipts=receipts):
+                        file_paths.append(file_path)
+                        continue
+
+                    if not overwrite:
+                        if verbose:
+                            print(f'non-matching file already exists at output path <{file_path}>, skipping')
+                        warnings.warn(f'file already exists: {file_path}')
+                        continue
+
+                # write file (the partial file is deleted if something fails)
+                with writer.open(file_path, '.partial') as f:
+                    f.write(file_content)
+                file_paths.append(file_path)
+                written_hashes[file_path] = packed_file['file_hash']
+
+        # so that the next run doesn't need to rehash these files
+        if written_hashes:
+            write_receipts(receipts_dir, self.hash_function, written_hashes, receipts)
+
+        # empty dirs have no content, so there's nothing to verify
+        num_dirs = 0
+        for empty_dir in self.empty_dirs:
+            dir_path = _output_path(output_dir, empty_dir)
+            if dir_path.exists() and not dir_path.is_dir():
+                if verbose:
+                    print(f'non-dir already exists at output path <{dir_path}>, skipping')
+                warnings.warn(f'file already exists: {dir_path}')
+                continue
+            dir_path.mkdir(parents=True, exist_ok=True)
+            num_dirs += 1
+
+        # erase originals (unless otherwise specified) and return
+        if remove_originals and len(file_paths) == len(_packed_paths(self.packed_files)) \
+                and num_dirs == len(self.empty_dirs):
+            self.remove()
+        return file_paths
+
+
+def _packed_paths(packed_files: List[dict]) -> List[Tuple[dict, str]]:
+    """
+    every relative path to restore from a pack, including identical copies
+    :return: list of (packed_files entry, relative path)
+    """
+    return [(packed_file, packed_path)
+            for packed_file in packed_files
+            for packed_path in [packed_file['file_path']] + packed_file.get('duplicate_paths', [])]
+
+
+def _output_path(output_dir: Path, file_name: str) -> Path:
+    """
+    join a (possibly relative) file name from a fragment header onto the output dir
+    refuses paths that would escape the output dir, or overwrite the receipts file (see write_receipts)
+    """
+    output_dir = output_dir.resolve()
+    file_path = (output_dir / file_name).resolve()
+    if output_dir not in file_path.parents:
+        raise ValueError(f'attempted path traversal: {file_name}')
+    if file_path == output_dir / RECEIPTS_FILE_NAME:
+        raise ValueError(f'file name is reserved for receipts of restored files: {file_name}')
+    return file_path
+
+
+def _scan_fragment_paths(input_dir: Path) -> Generator[Path, None, None]:
+    """
+    recursively find all files in input_dir that start with any of the READABLE_MAGIC_STRINGS
+    uses os.scandir, which gets the file type from the directory listing without a stat per file
+    """
+    magic_bytes = {magic_string.encode('ascii') for magic_string in READABLE_MAGIC_STRINGS}
+    magic_length = max(len(magic_string) for magic_string in READABLE_MAGIC_STRINGS)
+    dir_stack = [str(input_dir)]
+    while dir_stack:
+        with os.scandir(dir_stack.pop()) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dir_stack.append(dir_entry.path)
+                    continue
+
+                # skip incomplete writes
+                if not dir_entry.is_file() or dir_entry.name.endswith(('.tempfile', '.partial')):
+                    continue
+
+                with open(dir_entry.path, 'rb') as f:
+                    if f.readline(magic_length + 1).rstrip(b'\r\n') in magic_bytes:
+                        yield Path(dir_entry.path)
+
+
+def _find_fragmented_files(input_dir: Path,
+                           password: Optional[str] = None,
+                           ) -> Dict[Tuple[str, str, Optional[str], str], FragmentedFile]:
+    """
+    group all fragments in input_dir (and its subdirs) by the file they came from
+    identical content stored under different paths (or in different packs) is kept apart
+    :return: dict of (hash function, file hash, file name, json of other paths) -> FragmentedFile
+    """
+    fragmented_files = dict()
+    for txt_path in _scan_fragment_paths(input_dir):
+        text_fragment = TextFragment(txt_path, password=password, root_dir=input_dir)
+        other_paths = json.dumps([text_fragment.duplicate_paths, text_fragment.packed_files, text_fragment.empty_dirs],
+                                 sort_keys=True)
+        fragmented_files.setdefault((text_fragment.hash_function, text_fragment.file_hash, text_fragment.file_name,
+                                     other_paths),
+                                    FragmentedFile(text_fragment)).add(text_fragment)
+    return fragmented_files
+
+
+def _restoration(file_fragments: FragmentedFile) -> Optional[str]:
+    """
+    which FragmentedFile method restores a set of fragments: make_packed_files, make_files,
+    or None if fragments are missing (shared by defragment_files and defragment_files_async)
+    """
+    if file_fragments.get_extraction_plan() is None:
+        return None
+    if file_fragments.packed_files is not None:
+        return 'make_packed_files'
+    return 'make_files'
+
+
+def _report_restoration(file_fragments: FragmentedFile,
+                        file_name: Optional[str],
+                        out_paths: Optional[List[Path]],
+                        verbose: bool,
+                        ) -> None:
+    """
+    report what was restored, skipped or incomplete (shared by defragment_files and defragment_files_async)
+    :param out_paths: as returned by the method from _restoration, or None if fragments are missing
+    """
+    file_hash = file_fragments.file_hash
+    if out_paths is None:
+        if verbose:
+            print(f'incomplete file: {file_hash} with name {file_fragments.file_name}')
+        return
+
+    # how many paths should have been restored
+    if file_fragments.packed_files is not None:
+        num_paths = len(_packed_paths(file_fragments.packed_files))
+        skipped = f'some files in pack {file_hash}'
+    else:
+        num_paths = 1 + len(file_fragments.duplicate_paths) if file_name is None else 1
+        skipped = f'some copies of {file_hash}' if out_paths else file_hash
+
+    if len(out_paths) < num_paths:
+        if verbose:
+            print(f'skipped restoration of {skipped}')
+        else:
+            warnings.warn(f'skipped restoration of {skipped}')
+    elif verbose and file_fragments.packed_files is None:
+        for out_path in out_paths:
+            print(f'saved {file_hash} to path: {out_path}')
+
 
 def defragment_files(input_dir: Path,
                      password: Optional[str] = None,
                      file_name: Optional[str] = None,
                      remove_originals: bool = True,
                      overwrite: bool = False,
-                     verbose: bool = False
+                     verbose: bool = False,
+                     output_dir: Optional[Path] = None,
+                     durability: str = 'none',
+                     strict_verify: bool = False,
                      ) -> Generator[Path, None, None]:
-    fragmented_files = dict()
-
+    """
+    restore all complete files from the fragments in input_dir (including subdirs, e.g. from sharding)
+    files are restored to output_dir (defaults to input_dir)
+    files from packed fragments and identical copies (see duplicate_paths) are yielded individually
+    receipts of restored files are kept in output_dir, so that existing files are only rehashed
+    if they have changed since they were restored (or if strict_verify)
+    """
     input_dir = input_dir.resolve()
-    for txt_path in input_dir.glob('*'):
-        if not txt_path.is_file():
-            continue
-        with txt_path.open('rt') as f:
-            if f.read(len(MAGIC_STRING)) != MAGIC_STRING:
-                continue
-        text_fragment = TextFragment(txt_path, password=password)
-        fragmented_files.setdefault(text_fragment.file_hash, FragmentedFile(text_fragment)).add(text_fragment)
+    if output_dir is None:
+        output_dir = input_dir
+    fragmented_files = _find_fragmented_files(input_dir, password)
 
-    for file_hash, file_fragments in fragmented_files.items():
-        assert isinstance(file_fragments, FragmentedFile)
-        if file_fragments.get_extraction_plan() is not None:
-            out_path = file_fragments.make_file(output_dir=input_dir,
-                                                file_name=file_name,
-                                                remove_originals=remove_originals,
-                                                overwrite=overwrite,
-                                                verbose=verbose)
-
-            if out_path is not None:
-                if verbose:
-                    print(f'saved {file_hash} to path: {out_path}')
-                yield out_path
-
-            else:
-                if verbose:
-                    print(f'skipped restoration of {file_hash}')
-                else:
-                    warnings.warn(f'skipped restoration of {file_hash}')
+    # read the receipts file once per run rather than once per file
+    receipts = read_receipts(output_dir.resolve(), compact=True)
 
-        elif verbose:
-            print(f'incomplete file: {file_hash} with name {file_fragments.file_name}')
+    for file_fragments in fragmented_files.values():
+        assert isinstance(file_fragments, FragmentedFile)
+        restore_kwargs = dict(output_dir=output_dir,
+                              remove_originals=remove_originals,
+                              overwrite=overwrite,
+                              verbose=verbose,
+                              durability=durability,
+                              strict_verify=strict_verify,
+                              receipts=receipts)
+        out_paths = None
+        restoration = _restoration(file_fragments)
+        if restoration == 'make_packed_files':
+            out_paths = file_fragments.make_packed_files(**restore_kwargs)
+        elif restoration == 'make_files':
+            out_paths = file_fragments.make_files(file_name=file_name, **restore_kwargs)
+
+        _report_restoration(file_fragments, file_name, out_paths, verbose)
+        yield from out_paths or []
@@ -1,9 +1,20 @@
 import hashlib
 import hmac
+import json
 import math
+import mmap
 import os
 import warnings
+from contextlib import contextmanager
+from pathlib import Path
 from pathlib import PurePath
+from typing import BinaryIO
+from typing import Dict
+from typing import Generator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Union
 
 PEPPER = b'''Lr>=9ObAWplJB^>#g<QAK$,<+O'bK;UU:Eim%3S01WZdV4_5g-6Mao_EOS>3W,V7''' + \
@@ -19,6 +30,14 @@ PEPPER = b'''Lr>=9ObAWplJB^>#g<QAK$,<+O'bK;UU:Eim%3S01WZdV4_5g-6Mao_EOS>3W,V7'''
          b'''YtfljY&:CfD.E`q)^s4^E$?a>qhcZW`d6]n)KhHQjLQFFAYuFGl%Ios.oQbJoEBa''' + \
          b'''##Qh"?1FBV3gMEE<Ce`T/]QEjqZ)'N'A6!=(.>b^>3T-jjli+(QC?42@FmVAG)%<'''  # 768 almost-random bytes
 
+DURABILITY_LEVELS = ('none', 'batch', 'strict')
+HASH_FUNCTIONS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512',
+                  'sha3_256', 'sha3_512', 'blake2b', 'blake2s')
+HASH_METHODS = ('readinto', 'mmap')
+READ_BUFFER_SIZE = 1024 * 1024  # 2**20 is a multiple of every hash block size
+RECEIPTS_FILE_NAME = '.frag_receipts.jsonl'
+WRITE_BUFFER_SIZE = 1024 * 1024  # large buffer so the header and content go out in few syscalls
+
 
 def format_bytes(num_bytes: Union[float, int]) -> str:
     """
@@ -113,29 +132,169 @@ def format_seconds(num_seconds: Union[float, int]) -> str:
             return f'{minus}{num_seconds:,.0f} {unit}'
 
 
+def new_hash(hash_func: str = 'SHA1'):
+    """
+    create a hash object from a whitelisted hash function name
+    """
+    hash_func = hash_func.strip().lower()
+    assert hash_func in HASH_FUNCTIONS, f'hash function must be one of {HASH_FUNCTIONS}, got {hash_func}'
+    return getattr(hashlib, hash_func)()
+
+
 def hash_file(file_path: Union[PurePath, os.PathLike],
-              hash_func: str = 'SHA1'
+              hash_func: str = 'SHA1',
+              method: str = 'readinto'
               ) -> str:
-    hash_func = hash_func.strip().lower()
-    assert hash_func in ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
-    hash_obj = getattr(hashlib, hash_func)()
-    fd = os.open(str(file_path), (os.O_RDONLY | os.O_BINARY))  # the O_BINARY flag is windows-only
-    for block in iter(lambda: os.read(fd, 65536), b''):  # 2**16 is a multiple of the hash block size
-        hash_obj.update(block)
-    os.close(fd)
+    """
+    readinto: read blocks into a single reused buffer (no per-block allocation)
+    mmap:     map the whole file and hash it in one call (hashlib releases the GIL for large inputs)
+    """
+    assert method in HASH_METHODS, f'method must be one of {HASH_METHODS}, got {method}'
+    hash_obj = new_hash(hash_func)
+
+    with open(file_path, 'rb', buffering=0) as f:
+        if method == 'mmap':
+            # empty files can't be mapped
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hash_obj.update(mm)
+
+        else:
+            buffer = bytearray(READ_BUFFER_SIZE)
+            view = memoryview(buffer)
+            for num_bytes in iter(lambda: f.readinto(buffer), 0):
+                hash_obj.update(view[:num_bytes])
+
     return hash_obj.hexdigest().upper()
 
 
 def hash_content(content: Union[bytes, bytearray],
                  hash_func: str = 'SHA1'
                  ) -> str:
-    hash_func = hash_func.strip().lower()
-    assert hash_func in ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
-    hash_obj = getattr(hashlib, hash_func)()
+    hash_obj = new_hash(hash_func)
     hash_obj.update(content)
     return hash_obj.hexdigest().upper()
 
 
+def _receipt_key(receipts_dir: Path, file_path: Path) -> str:
+    return file_path.resolve().relative_to(receipts_dir.resolve()).as_posix()
+
+
+def read_receipts(receipts_dir: Path, compact: bool = False) -> Dict[str, dict]:
+    """
+    load the receipts of verified files in (or under) a directory
+    the receipts file is append-only, so later receipts for the same path win
+
+    :param compact: if superseded lines outnumber the live receipts, atomically rewrite the receipts file
+                    with only the live receipts (dropping those of files that no longer exist)
+    :return: dict of relative path -> receipt
+    """
+    receipts = dict()
+    receipts_path = receipts_dir / RECEIPTS_FILE_NAME
+    if not receipts_path.is_file():
+        return receipts
+
+    num_lines = 0
+    with receipts_path.open('rt', encoding='ascii') as f:
+        for line in f:
+            num_lines += 1
+            try:
+                receipt = json.loads(line)
+            except ValueError:
+                continue  # partially written line, e.g. after a power loss
+            receipts[receipt['file_path']] = receipt
+
+    if compact and num_lines > 2 * len(receipts):
+        receipts = {key: receipt for key, receipt in receipts.items() if (receipts_dir / key).is_file()}
+        with DurableWriter('strict') as writer, writer.open(receipts_path, '.tempfile') as f:
+            f.writelines(json.dumps(receipt, separators=(',', ':')).encode('ascii') + b'\n'
+                         for receipt in receipts.values())
+    return receipts
+
+
+def write_receipts(receipts_dir: Path,
+                   hash_func: str,
+                   file_hashes: Dict[Path, str],
+                   receipts: Optional[Dict[str, dict]] = None,
+                   ) -> None:
+    """
+    record that each file (which must be under receipts_dir) was verified to have the given hash
+    along with its size, mtime and inode, so it can be recognized later without rehashing
+
+    :param receipts: preloaded from read_receipts, updated in place with the new receipts
+    """
+    new_receipts = []
+    for file_path, file_hash in file_hashes.items():
+        stat = os.stat(str(file_path))
+        new_receipts.append({'file_path':     _receipt_key(receipts_dir, file_path),
+                             'hash_function': hash_func.strip().lower(),
+                             'file_hash':     file_hash,
+                             'file_size':     stat.st_size,
+                             'mtime_ns':      stat.st_mtime_ns,
+                             'inode':         stat.st_ino,
+                             })
+
+    with (receipts_dir / RECEIPTS_FILE_NAME).open('at', encoding='ascii') as f:
+        f.writelines(json.dumps(receipt, separators=(',', ':')) + '\n' for receipt in new_receipts)
+
+    if receipts is not None:
+        receipts.update((receipt['file_path'], receipt) for receipt in new_receipts)
+
+
+def verify_file(file_path: Path,
+                hash_func: str,
+                file_hash: str,
+                receipts_dir: Path,
+                strict: bool = False,
+                receipts: Optional[Dict[str, dict]] = None,
+                ) -> bool:
+    """
+    check if a file has the given hash
+    if its receipt still matches the file's size, mtime and inode, the file is not rehashed (unless strict)
+    a successful rehash writes a new receipt
+
+    :param receipts: preloaded from read_receipts, to avoid rereading the receipts file for many files
+                     (a new receipt is also added to it)
+    """
+    if not strict:
+        if receipts is None:
+            receipts = read_receipts(receipts_dir)
+        receipt = receipts.get(_receipt_key(receipts_dir, file_path))
+        if receipt is not None:
+            stat = os.stat(str(file_path))
+            if receipt == {'file_path':     receipt['file_path'],
+                           'hash_function': hash_func.strip().lower(),
+                           'file_hash':     file_hash,
+                           'file_size':     stat.st_size,
+                           'mtime_ns':      stat.st_mtime_ns,
+                           'inode':         stat.st_ino,
+                           }:
+                return True
+
+    if hash_file(file_path, hash_func=hash_func) != file_hash:
+        return False
+    write_receipts(receipts_dir, hash_func, {file_path: file_hash}, receipts)
+    return True
+
+
+def a85_encoded_size(num_bytes: int) -> int:
+    """
+    upper bound on the length of `base64.a85encode` output (exact unless some 4-byte groups are all zeros)
+    every 4 bytes become 5 chars, and a partial group of n bytes becomes n + 1 chars
+    """
+    full_groups, remainder = divmod(num_bytes, 4)
+    return full_groups * 5 + (remainder + 1 if remainder else 0)
+
+
+def a85_capacity(num_chars: int) -> int:
+    """
+    the most bytes that are guaranteed to a85-encode to at most num_chars
+    inverse of a85_encoded_size
+    """
+    full_groups, remainder = divmod(max(num_chars, 0), 5)
+    return full_groups * 4 + max(remainder - 1, 0)
+
+
 def key_derivation_function(password_string: Union[str, bytes, bytearray],
                             salt: Union[bytes, bytearray] = b'',
                             length: int = 512
@@ -153,3 +312,122 @@ def key_derivation_function(password_string: Union[str, bytes, bytearray],
         key_bytes = hmac.digest(PEPPER, password_string, digest=hashlib.sha3_512)
 
     return hashlib.scrypt(key_bytes, salt=salt + PEPPER, n=16384, r=32, p=1, dklen=length, maxmem=80 * 1024 * 1024)
+
+
+def fsync_directory(dir_path: Union[PurePath, os.PathLike]) -> None:
+    """
+    make a rename within the directory durable
+    windows doesn't allow opening directories, and NTFS journals renames anyway
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(str(dir_path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DurableWriter:
+    """
+    write files via a temp file that is renamed into place once complete
+
+    durability levels:
+        none:   rename immediately, never fsync (a power loss can leave renamed but empty files)
+        batch:  defer renames until batch_size files are pending (or flush / exit),
+                then fsync all pending files, rename them, and fsync each directory once
+        strict: fsync every file before renaming it, then fsync its directory
+    """
+
+    def __init__(self, durability: str = 'none', batch_size: int = 64):
+        durability = durability.strip().lower()
+        assert durability in DURABILITY_LEVELS, f'durability must be one of {DURABILITY_LEVELS}, got {durability}'
+        assert batch_size >= 1
+        self.durability = durability
+        self.batch_size = batch_size
+        self.pending: List[Tuple[Path, Path]] = []  # (temp path, final path)
+        self.pending_dirs: Set[Path] = set()  # dirs containing newly created subdirs
+
+    @contextmanager
+    def open(self, file_path: Path, temp_suffix: str = '.tempfile') -> Generator[BinaryIO, None, None]:
+        """
+        open a binary file for writing, which will appear at file_path (once flushed, in batch mode)
+        the temp file is deleted if anything goes wrong
+        """
+        temp_path = file_path.with_name(file_path.name + temp_suffix)
+        try:
+            with temp_path.open('wb', buffering=WRITE_BUFFER_SIZE) as f:
+                yield f
+                if self.durability == 'strict':
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        except BaseException:  # including KeyboardInterrupt and asyncio cancellation
+            if temp_path.exists():
+                temp_path.unlink()
+            raise
+
+        if self.durability == 'batch':
+            self.pending.append((temp_path, file_path))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+        else:
+            temp_path.replace(file_path)
+            if self.durability == 'strict':
+                fsync_directory(file_path.parent)
+
+    def mkdir(self, dir_path: Path) -> None:
+        """
+        create a directory (and its parents) such that the new directory entries are as durable as the files
+        """
+        missing_dirs = []
+        while not dir_path.exists():
+            missing_dirs.append(dir_path)
+            dir_path = dir_path.parent
+        for missing_dir in reversed(missing_dirs):
+            missing_dir.mkdir(exist_ok=True)
+
+        if self.durability == 'strict':
+            for parent_dir in sorted({missing_dir.parent for missing_dir in missing_dirs}):
+                fsync_directory(parent_dir)
+        elif self.durability == 'batch':
+            self.pending_dirs.update(missing_dir.parent for missing_dir in missing_dirs)
+
+    def flush(self) -> None:
+        """
+        make all pending files durable and rename them into place
+        """
+        pending, self.pending = self.pending, []
+        pending_dirs, self.pending_dirs = self.pending_dirs, set()
+
+        # flush file data before any rename, so a rename can never become durable before its data
+        for temp_path, _ in pending:
+            fd = os.open(str(temp_path), os.O_RDWR | getattr(os, 'O_BINARY', 0))  # windows needs write access
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        # then rename everything and flush each affected directory once
+        for temp_path, file_path in pending:
+            temp_path.replace(file_path)
+        for dir_path in sorted({file_path.parent for _, file_path in pending} | pending_dirs):
+            fsync_directory(dir_path)
+
+    def discard(self) -> None:
+        """
+        delete all pending temp files
+        """
+        pending, self.pending = self.pending, []
+        for temp_path, _ in pending:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()